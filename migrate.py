@@ -1,23 +1,88 @@
 import os
-import xml.etree.ElementTree as ET
+import sys
+import queue
+import logging
+import logging.handlers
+from lxml import etree as ET
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import html
+import re
 import json
 import time
-from datetime import datetime
-from urllib.parse import urlparse, unquote
-from bs4 import BeautifulSoup
-import mimetypes
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # 環境変数の読み込み
 load_dotenv()
 
+log = logging.getLogger('wp2mc')
+log.setLevel(logging.INFO)
+log.propagate = False
+
+def _dumps(data):
+    """JSONをUTF-8のバイト列にシリアライズ（orjsonがあれば優先して使う）"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+def _getenv_positive(name, default, cast):
+    """数値の環境変数を読み込む（正の数でなければNoneを返す）"""
+    try:
+        value = cast(os.getenv(name, default))
+    except ValueError:
+        return None
+    return value if value > 0 else None
+
+class _RateLimiter:
+    """リクエスト間隔を1/rps秒以上に保つ簡易レートリミッター"""
+    def __init__(self, rps):
+        self.interval = 1 / rps
+        self.last_call = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            wait_time = max(0, self.interval - (time.monotonic() - self.last_call))
+            if wait_time:
+                time.sleep(wait_time)
+            self.last_call = time.monotonic()
+
 class WPToMicroCMSMigration:
+    # 名前空間付きのタグ名は毎回解決せず、展開済みの形で保持しておく
+    _WP = '{http://wordpress.org/export/1.2/}'
+    _CONTENT = '{http://purl.org/rss/1.0/modules/content/}encoded'
+    _POST_TYPE = _WP + 'post_type'
+    _STATUS = _WP + 'status'
+    _DATE = _WP + 'post_date'
+    # カテゴリ・タグの抽出式は記事ごとに解釈せず、事前にコンパイルしておく
+    _CAT_XPATH = ET.XPath('category[@domain="category"]')
+    _TAG_XPATH = ET.XPath('category[@domain="post_tag"]')
+    # WordPressの本文に頻出する実体参照のみを扱う高速パス
+    _FAST_ENTITIES = {
+        '&amp;': '&', '&lt;': '<', '&gt;': '>', '&quot;': '"', '&#39;': "'", '&#x27;': "'"
+    }
+    _FAST_ENT = re.compile(r'&(?:amp|lt|gt|quot|#39|#x27);')
+    _OTHER_ENT = re.compile(r'&(?!(?:amp|lt|gt|quot|#39|#x27);)')
+
     def __init__(self):
         """環境変数から設定を読み込んで初期化"""
         self._load_config()
         self._validate_config()
+        # 同時実行数はAIMDで調整する（成功で加算、429/5xxで半減）
+        self._concurrency = float(self.max_workers)
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._limiter = _RateLimiter(self.rps)
+        self.session = self._create_session()
         self.image_cache = {}
 
     def _load_config(self):
@@ -25,12 +90,38 @@ class WPToMicroCMSMigration:
         self.xml_file = os.getenv('WP_XML_FILE')
         self.domain = os.getenv('MICROCMS_DOMAIN')
         self.api_key = os.getenv('MICROCMS_API_KEY')
-        self.api_endpoint = f"https://{self.domain}{os.getenv('MICROCMS_CONTENT_API_PATH')}"
-        self.media_api_endpoint = f"https://{self.domain}{os.getenv('MICROCMS_MEDIA_API_PATH')}"
+        self._content_path = os.getenv('MICROCMS_CONTENT_API_PATH')
+        self._media_path = os.getenv('MICROCMS_MEDIA_API_PATH')
+        self.api_endpoint = f"https://{self.domain}{self._content_path}"
+        self.media_api_endpoint = f"https://{self.domain}{self._media_path}"
         self.headers = {
             'X-MICROCMS-API-KEY': self.api_key,
             'Content-Type': 'application/json'
         }
+        # 一括登録エンドポイントがある場合のみ複数記事をまとめて送信する
+        self.batch_size = _getenv_positive('MICROCMS_BATCH_SIZE', '1', int)
+        batch_path = os.getenv('MICROCMS_BATCH_API_PATH')
+        self.batch_api_endpoint = f"https://{self.domain}{batch_path}" if batch_path else None
+        self.max_workers = _getenv_positive('MICROCMS_MAX_WORKERS', '8', int)
+        self.rps = _getenv_positive('MICROCMS_RPS', '5', float)
+
+    def _create_session(self):
+        """ワーカー数に合わせた接続プールを持つセッションを作成"""
+        # 同一ホストへの接続を使い回すためセッションを共有する
+        session = requests.Session()
+        session.headers.update(self.headers)
+        # 429/503の再試行は_post_with_retryで扱うため、ここでは接続エラーのみ再試行する
+        # （送信後の読み取りエラーを再送すると記事が重複登録されるためread=Falseとする）
+        retry = Retry(
+            total=3,
+            read=False,
+            status=0,
+            backoff_factor=0.5,
+            allowed_methods=frozenset(['POST'])
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers, max_retries=retry)
+        session.mount('https://', adapter)
+        return session
 
     def _validate_config(self):
         """設定値の存在確認と検証"""
@@ -38,84 +129,196 @@ class WPToMicroCMSMigration:
             'WP_XML_FILE': self.xml_file,
             'MICROCMS_DOMAIN': self.domain,
             'MICROCMS_API_KEY': self.api_key,
-            'MICROCMS_CONTENT_API_PATH': os.getenv('MICROCMS_CONTENT_API_PATH'),
-            'MICROCMS_MEDIA_API_PATH': os.getenv('MICROCMS_MEDIA_API_PATH')
+            'MICROCMS_CONTENT_API_PATH': self._content_path,
+            'MICROCMS_MEDIA_API_PATH': self._media_path
         }
         missing_vars = [var for var, value in required_vars.items() if not value]
+        if self.batch_size and self.batch_size > 1 and not self.batch_api_endpoint:
+            missing_vars.append('MICROCMS_BATCH_API_PATH')
         if missing_vars:
             raise ValueError(f"必要な環境変数が設定されていません: {', '.join(missing_vars)}")
+        numeric_vars = {
+            'MICROCMS_BATCH_SIZE': self.batch_size,
+            'MICROCMS_MAX_WORKERS': self.max_workers,
+            'MICROCMS_RPS': self.rps
+        }
+        invalid_vars = [var for var, value in numeric_vars.items() if value is None]
+        if invalid_vars:
+            raise ValueError(f"環境変数には正の数を指定してください: {', '.join(invalid_vars)}")
         if not os.path.exists(self.xml_file):
             raise FileNotFoundError(f"指定されたXMLファイルが見つかりません: {self.xml_file}")
 
     def parse_wordpress_xml(self):
-        """WordPressのXMLファイルを解析して記事データを取得"""
-        tree = ET.parse(self.xml_file)
-        root = tree.getroot()
-        namespaces = {
-            'content': 'http://purl.org/rss/1.0/modules/content/',
-            'wp': 'http://wordpress.org/export/1.2/',
-            'excerpt': 'http://wordpress.org/export/1.2/excerpt/'
-        }
-        return [
-            {
-                'title': item.find('title').text,
-                'content': item.find('content:encoded', namespaces).text,
-                'date': item.find('wp:post_date', namespaces).text,
-                'categories': [cat.text for cat in item.findall('category[@domain="category"]')],
-                'tags': [tag.text for tag in item.findall('category[@domain="post_tag"]')]
-            }
-            for item in root.findall('.//item')
-            if item.find('wp:post_type', namespaces).text == 'post' and item.find('wp:status', namespaces).text == 'publish'
-        ]
+        """WordPressのXMLファイルを逐次解析して記事データを1件ずつ返す"""
+        for _, item in ET.iterparse(self.xml_file, events=('end',), tag='item', huge_tree=True):
+            # 公開済みの投稿以外（固定ページ・添付ファイル・メニュー等）は辞書を作らずに読み飛ばす
+            if item.findtext(self._POST_TYPE) == 'post' and item.findtext(self._STATUS) == 'publish':
+                yield {
+                    'title': item.findtext('title'),
+                    'content': item.findtext(self._CONTENT),
+                    'date': item.findtext(self._DATE),
+                    'categories': [cat.text for cat in self._CAT_XPATH(item)],
+                    'tags': [tag.text for tag in self._TAG_XPATH(item)]
+                }
+            # 処理済みの要素を解放してメモリ使用量を一定に保つ
+            item.clear()
+            while item.getprevious() is not None:
+                del item.getparent()[0]
 
     def clean_content(self, content):
         """HTMLコンテンツのクリーニングと画像の処理"""
-        return html.unescape(content) if content else content
+        if not content or '&' not in content:
+            return content
+        if not self._OTHER_ENT.search(content):
+            return self._FAST_ENT.sub(lambda m: self._FAST_ENTITIES[m.group(0)], content)
+        return html.unescape(content)
 
     def upload_to_microcms(self, posts):
-        """記事をmicroCMSにアップロード"""
+        """記事をmicroCMSに並列でアップロード"""
         success_count, failed_count = 0, 0
-        for post in posts:
-            if self._upload_post(post):
-                success_count += 1
-            else:
-                failed_count += 1
-            time.sleep(1)
+
+        def collect(done):
+            nonlocal success_count, failed_count
+            for future in done:
+                succeeded = int(future.result())
+                success_count += succeeded
+                failed_count += pending.pop(future) - succeeded
+
+        if self.batch_size > 1:
+            posts = iter(posts)
+            units = iter(lambda: list(islice(posts, self.batch_size)), [])
+            task = self._upload_batch
+        else:
+            units = ([post] for post in posts)
+            task = lambda unit: self._upload_post(unit[0])
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {}
+            for unit in units:
+                # 未完了のタスク数を抑えて記事を読み込みすぎないようにする
+                if len(pending) >= self.max_workers * 2:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                pending[executor.submit(task, unit)] = len(unit)
+            collect(wait(pending).done)
         return success_count, failed_count
 
+    def _build_post_data(self, post):
+        """microCMSに送信する記事データを組み立てる"""
+        return {
+            'title': post['title'],
+            'body': self.clean_content(post['content']),
+            # 'publishedAt': datetime.strptime(post['date'], '%Y-%m-%d %H:%M:%S').isoformat(),
+            # 'categories': post['categories'],
+            # 'tags': post['tags']
+        }
+
     def _upload_post(self, post):
         """単一の記事をmicroCMSにアップロード"""
         try:
-            data = {
-                'title': post['title'],
-                'body': self.clean_content(post['content']),
-                # 'publishedAt': datetime.strptime(post['date'], '%Y-%m-%d %H:%M:%S').isoformat(),
-                # 'categories': post['categories'],
-                # 'tags': post['tags']
-            }
-            response = requests.post(self.api_endpoint, headers=self.headers, json=data)
+            response = self._post_with_retry(self.api_endpoint, self._build_post_data(post))
             if response.status_code == 201:
-                print(f"記事をアップロードしました: {post['title']}")
+                log.info(f"記事をアップロードしました: {post['title']}")
                 return True
             else:
-                print(f"記事のアップロードに失敗: {post['title']}")
-                print(f"エラー: {response.text}")
+                log.error(f"記事のアップロードに失敗: {post['title']}")
+                log.error(f"エラー: {response.text}")
                 return False
         except Exception as e:
-            print(f"記事のアップロードでエラー {post['title']}: {str(e)}")
+            log.error(f"記事のアップロードでエラー {post['title']}: {str(e)}")
             return False
 
+    def _upload_batch(self, posts):
+        """複数の記事を一括登録エンドポイントにまとめてアップロードし、成功件数を返す"""
+        try:
+            data = {'contents': [self._build_post_data(post) for post in posts]}
+            response = self._post_with_retry(self.batch_api_endpoint, data)
+            if response.status_code not in (200, 201):
+                log.error(f"記事の一括アップロードに失敗: {len(posts)}件")
+                log.error(f"エラー: {response.text}")
+                return 0
+            results = response.json()
+        except Exception as e:
+            log.error(f"記事の一括アップロードでエラー ({len(posts)}件): {str(e)}")
+            return 0
+        if not (isinstance(results, list) and len(results) == len(posts)
+                and all(isinstance(result, dict) for result in results)):
+            log.error(f"一括アップロードの応答形式が不正です ({len(posts)}件): {response.text}")
+            for post in posts:
+                log.error(f"記事のアップロード結果を確認できません: {post['title']}")
+            return 0
+        success_count = 0
+        for post, result in zip(posts, results):
+            if result.get('status_code') == 201:
+                log.info(f"記事をアップロードしました: {post['title']}")
+                success_count += 1
+            else:
+                log.error(f"記事のアップロードに失敗: {post['title']}")
+                log.error(f"エラー: {result.get('body')}")
+        return success_count
+
+    def _post_with_retry(self, endpoint, data, max_attempts=3):
+        """429/503の場合はバックオフしながら再試行してPOSTする"""
+        # 再試行時に再シリアライズしないよう一度だけバイト列にしておく
+        body = _dumps(data)
+        backoff = 1
+        for attempt in range(max_attempts):
+            with self._cond:
+                while self._in_flight >= int(self._concurrency):
+                    self._cond.wait()
+                self._in_flight += 1
+            try:
+                self._limiter.acquire()
+                response = self.session.post(endpoint, data=body)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify_all()
+
+            # 5xxは同時実行数を下げる合図にとどめ、再送は登録されていないことが明らかな429/503のみとする
+            retryable = response.status_code in (429, 503)
+            self._adjust_concurrency(
+                retryable or response.status_code >= 500
+                or response.headers.get('X-RateLimit-Remaining') == '0'
+            )
+            if not retryable or attempt == max_attempts - 1:
+                return response
+            try:
+                delay = float(response.headers.get('Retry-After', backoff))
+            except ValueError:
+                delay = backoff
+            time.sleep(min(delay, 60) if delay >= 0 else 0)
+            backoff = min(backoff * 2, 60)
+
+    def _adjust_concurrency(self, throttled):
+        """レスポンスに応じて同時実行数を増減する"""
+        with self._cond:
+            if throttled:
+                self._concurrency = max(1.0, self._concurrency * 0.5)
+            else:
+                self._concurrency = min(float(self.max_workers), self._concurrency + 0.5)
+            self._cond.notify_all()
+
     def migrate(self):
         """移行プロセスの実行"""
-        print("WordPress記事の解析を開始...")
-        posts = self.parse_wordpress_xml()
-        print(f"{len(posts)}件の記事を検出しました")
-        print("microCMSへの移行を開始...")
-        success, failed = self.upload_to_microcms(posts)
-        print(f"\n移行完了:")
-        print(f"成功: {success}件")
-        print(f"失敗: {failed}件")
-        print(f"処理した画像: {len(self.image_cache)}件")
+        # ワーカーがstdoutのロックを奪い合わないよう、ログはキュー経由で出力する
+        log_queue = queue.Queue(-1)
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+        log.addHandler(queue_handler)
+        listener.start()
+        try:
+            log.info("WordPress記事の解析とmicroCMSへの移行を開始...")
+            posts = self.parse_wordpress_xml()
+            success, failed = self.upload_to_microcms(posts)
+            log.info(f"\n移行完了:")
+            log.info(f"検出した記事: {success + failed}件")
+            log.info(f"成功: {success}件")
+            log.info(f"失敗: {failed}件")
+            log.info(f"処理した画像: {len(self.image_cache)}件")
+        finally:
+            self.session.close()
+            log.removeHandler(queue_handler)
+            listener.stop()
 
 def main():
     try: